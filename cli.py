@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import collections
 from pathlib import Path
 from nearai import EntryLocation
@@ -31,11 +32,11 @@ def main():
         directory_path = Path(args.output_dir)
         directory_path.mkdir(parents=True, exist_ok=True)
 
-    index_by_location(EntryLocation(
+    asyncio.run(index_by_location(EntryLocation(
         namespace=namespace,
         name=name,
         version=version
-    ), output_directory=args.output_dir)
+    ), output_directory=args.output_dir))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
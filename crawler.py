@@ -1,105 +1,258 @@
+import ast
+import hashlib
+import importlib.machinery
+import io
 import os
 import pathlib
-
-import tree_sitter_languages as tsl
-from tree_sitter import Node, Language, Parser
-from typing import Set, List, Dict
-import tree_sitter_python as tspython
+import pickle
+import sqlite3
+import sys
+from collections import deque
+
+from typing import Set, List, Dict, Iterator, Optional, Tuple
+
+# Size budget of the concatenated code sent to the LLM, keeps a fixed context window
+MAX_CONCATENATED_SIZE = 100_000
+
+# Extracted file facts are persisted here between runs
+CACHE_DIR = pathlib.Path.home() / '.cache' / 'a2a-agent-card-generator'
+# Bump whenever the extracted facts change shape or content
+_CACHE_VERSION = 3
+
+# In-process cache of extracted facts, keyed by (path, sha256 of content)
+_facts_memo: Dict[Tuple[str, str], Dict] = {}
+
+_FUNCTION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef)
+# Nodes printed with their source text by print_ast_structure
+_TEXT_TYPES = (ast.Name, ast.Constant, ast.alias, ast.arg)
+
+
+def _walk(root: ast.AST) -> Iterator[Tuple[ast.AST, int]]:
+    """
+    Pre-order walk over the subtree of `root`, yielding (node, depth relative to root).
+    Unlike ast.walk, nodes come in source order.
+    """
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        children = list(ast.iter_child_nodes(node))
+        stack.extend((child, depth + 1) for child in reversed(children))
+
+
+def _find_module_file(module_name: str, search_paths: List[str]) -> Optional[str]:
+    """
+    Resolve a dotted module name to its .py source within search_paths the way
+    the import system does (packages, namespace packages), without importing anything.
+    """
+    spec = None
+    for part in module_name.split('.'):
+        if search_paths is None:
+            # Parent is a plain module, it can't have submodules
+            return None
+
+        try:
+            # Only the last component is looked up, so the finder never consults sys.modules for parents
+            spec = importlib.machinery.PathFinder.find_spec(part, list(search_paths))
+        except (ImportError, KeyError):
+            return None
+
+        if spec is None:
+            return None
+
+        if spec.origin is None:
+            # Namespace package, its portions are the same-named directories of the search paths
+            search_paths = [os.path.join(path, part) for path in search_paths
+                            if os.path.isdir(os.path.join(path, part))]
+        else:
+            search_paths = spec.submodule_search_locations
+
+    if spec.origin and spec.origin.endswith('.py'):
+        return spec.origin
+
+    return None
+
+
+def _resolve_import(imp: str, current_dir: str, base_dir: str) -> Optional[str]:
+    """Resolve a module name imported from a file in current_dir to its .py source inside base_dir."""
+    module_name = imp.lstrip('.')
+    level = len(imp) - len(module_name)
+    if not level:
+        search_paths = [base_dir] if current_dir == base_dir else [base_dir, current_dir]
+        return _find_module_file(module_name, search_paths)
+
+    # Relative imports are resolved against their package only,
+    # which is the importing file's directory raised level - 1 times
+    package_dir = current_dir
+    for _ in range(level - 1):
+        package_dir = os.path.dirname(package_dir)
+
+    root_dir = os.path.normpath(base_dir)
+    if os.path.commonpath([os.path.normpath(package_dir), root_dir]) != root_dir:
+        return None
+
+    return _find_module_file(module_name, [package_dir])
+
+
+class FactsCache:
+    """
+    SQLite store of facts extracted from Python files,
+    keyed by file path and sha256 of its content.
+    """
+
+    def __init__(self, cache_dir: pathlib.Path = CACHE_DIR):
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # ast results depend on the interpreter's grammar, so each Python version has its own cache
+            python_version = '{}{}'.format(*sys.version_info[:2])
+            self.connection = sqlite3.connect(cache_dir / f'ast_cache_v{_CACHE_VERSION}_py{python_version}.sqlite3')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS ast_cache '
+                '(path TEXT, sha TEXT, payload BLOB, PRIMARY KEY (path, sha))'
+            )
+        except (OSError, sqlite3.Error) as e:
+            print(f"AST cache is disabled: {e}")
+            self.connection = None
+
+    def get(self, path: str, sha: str) -> Optional[Dict]:
+        if self.connection is None:
+            return None
+
+        try:
+            row = self.connection.execute(
+                'SELECT payload FROM ast_cache WHERE path = ? AND sha = ?', (path, sha)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading AST cache for {path}: {e}")
+            return None
+
+        return pickle.loads(row[0]) if row else None
+
+    def put(self, path: str, sha: str, facts: Dict):
+        if self.connection is None:
+            return
+
+        # Content changed, so facts for older versions of the file are stale
+        try:
+            with self.connection:
+                self.connection.execute('DELETE FROM ast_cache WHERE path = ?', (path,))
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO ast_cache (path, sha, payload) VALUES (?, ?, ?)',
+                    (path, sha, pickle.dumps(facts))
+                )
+        except sqlite3.Error as e:
+            # Entries are indexed concurrently, another walker may hold the lock
+            print(f"Error writing AST cache for {path}: {e}")
 
 
 class PythonCodeWalker:
-    def __init__(self):
-        # Get the Python language parser
-        self.language = Language(tspython.language())
-        self.parser = Parser()
-        self.parser.language = self.language
+    def __init__(self, cache: Optional[FactsCache] = None):
+        self.cache = cache if cache is not None else FactsCache()
 
-    def parse_file(self, filepath: str) -> Node:
+    def parse_file(self, filepath: str) -> ast.Module:
         """Parse a Python file and return its AST root node."""
-        with open(filepath, 'r', encoding='utf-8') as f:
-            code = f.read()
+        _, tree = self._parse_bytes_from_file(filepath)
+        return tree
 
-        tree = self.parser.parse(bytes(code, 'utf-8'))
-        return tree.root_node
+    def _parse_bytes_from_file(self, filepath: str) -> Tuple[bytes, ast.Module]:
+        """Read a Python file once and return its raw bytes together with the AST root node."""
+        with open(filepath, 'rb') as f:
+            source_code = f.read()
 
-    def extract_imports(self, node: Node, source_code: bytes) -> List[str]:
-        """Extract all imports from a Python file's AST."""
+        return source_code, self._parse_bytes(source_code, filepath)
+
+    def _parse_bytes(self, source_code: bytes, filepath: str = '<unknown>') -> ast.Module:
+        # ast.parse honours the encoding declaration, so there is no need to decode the file first
+        return ast.parse(source_code, filename=filepath)
+
+    def extract_all(self, node: ast.AST, source_code: Optional[bytes] = None) -> Dict[str, List]:
+        """
+        Extract imports and function definitions in a single pass over the AST.
+        Names are read from the tree itself, source_code is kept for compatibility.
+        """
         imports = []
+        functions = []
+        for child, _ in _walk(node):
+            if isinstance(child, ast.Import):
+                # Extract module names from 'import X, Y' statements
+                imports.extend(alias.name for alias in child.names)
+            elif isinstance(child, ast.ImportFrom):
+                # Extract module name from 'from X import Y' statements,
+                # relative imports keep their leading dots
+                prefix = '.' * child.level
+                if child.module:
+                    imports.append(prefix + child.module)
+                elif child.level:
+                    # 'from . import X' imports sibling module X
+                    imports.extend(prefix + alias.name for alias in child.names if alias.name != '*')
+            elif isinstance(child, _FUNCTION_TYPES):
+                functions.append({
+                    'name': child.name,
+                    'parameters': [arg.arg for arg in child.args.args],
+                    'line': child.lineno
+                })
+
+        return {'imports': imports, 'functions': functions}
+
+    def extract_imports(self, node: ast.AST, source_code: Optional[bytes] = None) -> List[str]:
+        """Extract all imports from a Python file's AST."""
+        return self.extract_all(node)['imports']
 
-        def walk_imports(node: Node):
-            if node.type == 'import_statement':
-                # Extract module names from import statements
-                for child in node.children:
-                    if child.type == 'dotted_name':
-                        module_name = source_code[child.start_byte:child.end_byte].decode('utf-8')
-                        imports.append(module_name)
-
-            elif node.type == 'import_from_statement':
-                # Extract module name from 'from X import Y' statements
-                for child in node.children:
-                    if child.type == 'dotted_name':
-                        module_name = source_code[child.start_byte:child.end_byte].decode('utf-8')
-                        imports.append(module_name)
-                        break
-
-            # Recursively walk children
-            for child in node.children:
-                walk_imports(child)
-
-        walk_imports(node)
-        return imports
-
-    def find_function_definitions(self, node: Node, source_code: bytes) -> List[Dict]:
+    def find_function_definitions(self, node: ast.AST, source_code: Optional[bytes] = None) -> List[Dict]:
         """Find all function definitions in the AST."""
-        functions = []
+        return self.extract_all(node)['functions']
+
+    def analyze_file(self, filepath: str) -> Dict:
+        """
+        Extract imports, functions, size and line count of a Python file.
+        Files whose content was already seen are served from the cache.
+        """
+        with open(filepath, 'rb') as f:
+            source_code = f.read()
+
+        key = (filepath, hashlib.sha256(source_code).hexdigest())
+        info = _facts_memo.get(key)
+        if info is None:
+            info = self.cache.get(*key)
 
-        def walk_functions(node: Node):
-            if node.type == 'function_definition':
-                # Get function name
-                name_node = next((child for child in node.children if child.type == 'identifier'), None)
-                if name_node:
-                    func_name = source_code[name_node.start_byte:name_node.end_byte].decode('utf-8')
-
-                    # Get function parameters
-                    params_node = next((child for child in node.children if child.type == 'parameters'), None)
-                    params = []
-                    if params_node:
-                        for param in params_node.children:
-                            if param.type == 'identifier':
-                                params.append(source_code[param.start_byte:param.end_byte].decode('utf-8'))
-
-                    functions.append({
-                        'name': func_name,
-                        'parameters': params,
-                        'line': node.start_point[0] + 1  # Line numbers are 0-indexed
-                    })
-
-            # Recursively walk children
-            for child in node.children:
-                walk_functions(child)
-
-        walk_functions(node)
-        return functions
-
-    def walk_directory(self, start_file: str, base_dir: str = None) -> Dict:
+        if info is None:
+            try:
+                extracted = self.extract_all(self._parse_bytes(source_code, filepath))
+            except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+                # Code this interpreter can't parse is still worth sending to the LLM
+                print(f"Could not parse {filepath}, its imports are not followed: {e}")
+                extracted = {'imports': [], 'functions': []}
+
+            info = {
+                **extracted,
+                'size': len(source_code),
+                'lines': source_code.count(b'\n') + 1
+            }
+            self.cache.put(*key, info)
+
+        _facts_memo[key] = info
+        return info
+
+    def walk_directory(self, start_file: str, base_dir: str = None, max_bytes: Optional[int] = None) -> Dict:
         """
         Walk through directory starting from a specific file,
         following imports to discover related files.
+        If max_bytes is given, the walk stops once the discovered files reach that size.
         """
         if base_dir is None:
             base_dir = os.path.dirname(os.path.abspath(start_file))
 
-        visited_files = set()
-        files_to_process = [os.path.join(base_dir, start_file)]
+        start_path = os.path.join(base_dir, start_file)
+        files_to_process = deque([start_path])
+        # Every path is enqueued at most once, even if imported from many files
+        queued_files = {start_path}
         result = {}
+        accumulated_size = 0
+        # Each module name is resolved once per importing directory
+        resolved_modules: Dict[Tuple[str, str], Optional[str]] = {}
 
         while files_to_process:
-            current_file = files_to_process.pop(0)
-
-            if current_file in visited_files:
-                continue
-
-            visited_files.add(current_file)
+            current_file = files_to_process.popleft()
 
             if not os.path.exists(current_file) or not current_file.endswith('.py'):
                 continue
@@ -107,79 +260,103 @@ class PythonCodeWalker:
             print(f"Processing: {current_file}")
 
             try:
-                # Parse the file
-                root_node = self.parse_file(current_file)
-                with open(current_file, 'rb') as f:
-                    source_code = f.read()
-
-                # Extract information
-                imports = self.extract_imports(root_node, source_code)
-                functions = self.find_function_definitions(root_node, source_code)
-
-                result[current_file] = {
-                    'imports': imports,
-                    'functions': functions,
-                    'size': len(source_code),
-                    'lines': source_code.count(b'\n') + 1
-                }
-
-                # Try to find imported files in the same directory structure
-                for imp in imports:
-                    # Convert module name to file path
-                    module_path = imp.replace('.', os.sep) + '.py'
-                    possible_paths = [
-                        os.path.join(base_dir, module_path),
-                        os.path.join(os.path.dirname(current_file), module_path),
-                        os.path.join(base_dir, imp + '.py'),
-                        os.path.join(os.path.dirname(current_file), imp + '.py')
-                    ]
-
-                    for path in possible_paths:
-                        if os.path.exists(path) and path not in visited_files:
-                            files_to_process.append(path)
-                            break
-
+                info = self.analyze_file(current_file)
             except Exception as e:
                 print(f"Error processing {current_file}: {e}")
                 result[current_file] = {'error': str(e)}
+                continue
+
+            result[current_file] = info
+
+            # Files discovered from here on would not fit into the budget
+            accumulated_size += info['size']
+            if max_bytes is not None and accumulated_size >= max_bytes:
+                break
+
+            # Try to find imported files in the same directory structure
+            current_dir = os.path.dirname(current_file)
+            for imp in info['imports']:
+                key = (imp, current_dir)
+                if key not in resolved_modules:
+                    resolved_modules[key] = _resolve_import(imp, current_dir, base_dir)
+
+                path = resolved_modules[key]
+                if path is not None and path not in queued_files:
+                    queued_files.add(path)
+                    files_to_process.append(path)
 
         return result
 
-    def print_ast_structure(self, node: Node, source_code: bytes, indent: int = 0):
+    def print_ast_structure(self, node: ast.AST, source_code: Optional[bytes] = None, indent: int = 0):
         """Print the AST structure for debugging."""
-        indent_str = "  " * indent
-
-        # Get node text if it's a leaf node
-        if len(node.children) == 0:
-            text = source_code[node.start_byte:node.end_byte].decode('utf-8', errors='ignore')
-            # Truncate long text
-            if len(text) > 50:
-                text = text[:50] + "..."
-            print(f"{indent_str}{node.type}: {repr(text)}")
-        else:
-            print(f"{indent_str}{node.type}")
-
-        # Recursively print children
-        for child in node.children:
-            self.print_ast_structure(child, source_code, indent + 1)
+        for child, depth in _walk(node):
+            # Load/Store/Del markers only add noise under every name
+            if isinstance(child, ast.expr_context):
+                continue
 
+            indent_str = "  " * (indent + depth)
+            node_type = type(child).__name__
+            is_leaf = all(isinstance(c, ast.expr_context) for c in ast.iter_child_nodes(child))
+
+            # Get node text if it's an identifier, literal or a leaf node (operators have none)
+            text = ast.unparse(child) if is_leaf or isinstance(child, _TEXT_TYPES) else ''
+            if text:
+                # Truncate long text
+                if len(text) > 50:
+                    text = text[:50] + "..."
+                print(f"{indent_str}{node_type}: {repr(text)}")
+            else:
+                print(f"{indent_str}{node_type}")
+
+
+def _has_other_sources(base_dir: str, start_file: str) -> bool:
+    """Check if base_dir has Python modules or packages besides start_file."""
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name != '__pycache__':
+                    return True
+            elif entry.name.endswith('.py') and entry.name != start_file:
+                return True
+
+    return False
+
+
+def get_concatenated_files_to_analyze(start_file: str, base_dir: str = None,
+                                      max_bytes: int = MAX_CONCATENATED_SIZE) -> str:
+    if base_dir is None:
+        base_dir = os.path.dirname(os.path.abspath(start_file))
+
+    # Most agents are a single agent.py, there are no imports to follow for them
+    start_path = os.path.join(base_dir, start_file)
+    if os.path.dirname(start_file) == '' and os.path.isfile(start_path) \
+            and not _has_other_sources(base_dir, start_file):
+        print(f"\nFile: {start_path}")
+        code = pathlib.Path(start_path).read_text('utf-8', errors='replace')
+        return f"## {start_path}\n{code}"[:max_bytes]
 
-def get_concatenated_files_to_analyze(start_file: str, base_dir: str = None) -> str:
     walker = PythonCodeWalker()
-    results = walker.walk_directory(start_file, base_dir)
+    results = walker.walk_directory(start_file, base_dir, max_bytes=max_bytes)
 
-    files = []
+    files = io.StringIO()
     for filepath, info in results.items():
         print(f"\nFile: {filepath}")
         if 'error' in info:
             print(f"  Error: {info['error']}")
         else:
             if os.path.exists(filepath):
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    code = f.read()
-                    files.append(f"## {filepath}\n{code}")
-
-    return "\n\n".join(files)
+                if files.tell():
+                    files.write("\n\n")
+                files.write(f"## {filepath}\n")
+                # Read only as much of the file as still fits into the budget,
+                # sources in other encodings are sent with undecodable bytes replaced
+                with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+                    files.write(f.read(max(max_bytes - files.tell(), 0)))
+
+        if files.tell() >= max_bytes:
+            break
+
+    return files.getvalue()[:max_bytes]
 
 # Example usage
 if __name__ == "__main__":
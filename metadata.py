@@ -1,22 +1,35 @@
-import json
+import asyncio
+import functools
 import logging
 import os
+import re
 from pathlib import Path
 from traceback import format_exc
-from typing import List, Optional
-from openai import OpenAI
+from typing import List, Optional, Tuple
+import httpx
+import orjson
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from nearai import EntryLocation
 from nearai.openapi_client import EntryInformation
-from pydantic import BaseModel, HttpUrl, Field
+from pydantic import BaseModel, HttpUrl, Field, TypeAdapter, ValidationError
 from nearai.registry import registry
 from dotenv import load_dotenv
-from tree_sitter import Language, Parser
 
 from crawler import get_concatenated_files_to_analyze
 
 load_dotenv(verbose=True)
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
+# Number of registry entries indexed at the same time, keeps us within OpenAI rate limits
+MAX_CONCURRENT_ENTRIES = 8
+
+# Registry is listed page by page, several pages are fetched at the same time
+REGISTRY_PAGE_SIZE = 1000
+REGISTRY_CONCURRENT_PAGES = 8
+
+# LLM usually wraps the JSON answer into a fenced code block, fences start at the beginning of a line
+_FENCE_RE = re.compile(r"^```(?:json)?[ \t]*\n(.*?)^```", re.DOTALL | re.MULTILINE)
+
 
 class Provider(BaseModel):
     organization: str
@@ -64,46 +77,79 @@ class AgentCard(BaseModel):
     skills: List[Skill]
 
 
-def index_by_location(entry_location: EntryLocation, output_directory: str = "./cards"):
+class CombinedCards(BaseModel):
+    a2a: AgentCard
+    near: NearAIMetadataCard
+
+
+# Finalize the models and build the validators once. Answers are validated straight from JSON,
+# cards are validated on their own only when the combined answer is invalid
+CombinedCards.model_rebuild()
+_CARDS_ADAPTER = TypeAdapter(CombinedCards)
+_A2A_ADAPTER = TypeAdapter(AgentCard)
+_NEARAI_ADAPTER = TypeAdapter(NearAIMetadataCard)
+
+# Schema and instructions are static, only the entry location is substituted per request
+_CARDS_SCHEMA_STR = orjson.dumps(CombinedCards.model_json_schema(), option=orjson.OPT_INDENT_2).decode()
+_CARDS_INSTRUCTIONS = (
+    "You're very good python engineer, and you can understand the python code very well."
+    "You're provided with the python code that is a entrypoint to the agent (agent.py).  "
+    "You're provided with the current description of the agent that can be incomplete (metadata.json)."
+    "Your task is to generate two cards on what this agent is doing "
+    "and return them in one JSON object with given schema:"
+    + _CARDS_SCHEMA_STR.replace("{", "{{").replace("}", "}}") +
+    "The `a2a` card is an agent card with very detailed description on what this agent is doing."
+    "For the provided use: near.ai"
+    "For the provider url use: near.ai"
+    "For the agent url use: https://app.near.ai/agents/{entry_location_str}"
+    "The `near` card is a NEAR AI metadata card with very detailed description on what this agent is doing, "
+    "but do not go into technical details, description should be in business language "
+    "and not in technical language."
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client() -> AsyncOpenAI:
+    # Created on first use and shared, so all requests reuse one connection pool
+    http_client = DefaultAsyncHttpxClient(
+        # HTTP/2 requires the h2 package, installed with httpx[http2]
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    )
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
+
+
+async def index_by_location(entry_location: EntryLocation, output_directory: str = "./cards"):
     entry_location_str = f"{entry_location.namespace}/{entry_location.name}/{entry_location.version}"
     logging.info(f"Starting indexing of entry: {entry_location_str}")
 
     # Download agent codebase
-    path = registry.download(entry_location, show_progress=True, verbose=True, force=True)
+    path = await asyncio.to_thread(registry.download, entry_location, show_progress=True, verbose=True, force=True)
     logging.info(f"Entry was downloaded to {path}")
 
     # agent_py = Path(path, "agent.py").read_text("utf-8")
-    agent_py = get_concatenated_files_to_analyze("agent.py", path)
-
-    # have fixed context window
-    if len(agent_py) >= 100000:
-        agent_py = agent_py[:100000]
+    # have fixed context window, the walk stops once the code reaches MAX_CONCATENATED_SIZE
+    agent_py = await asyncio.to_thread(get_concatenated_files_to_analyze, "agent.py", path)
 
     metadata_json = Path(path, "metadata.json").read_text("utf-8")
 
-    generate_a2a_card(agent_py, metadata_json, entry_location_str, output_directory)
-    generate_nearai_metadata_json(agent_py, metadata_json, entry_location_str, output_directory)
+    await generate_cards(agent_py, metadata_json, entry_location_str, output_directory)
 
-def index_by_entry(entry: EntryInformation):
+async def index_by_entry(entry: EntryInformation):
     entry_location = EntryLocation(
         namespace=entry.namespace,
         name=entry.name,
         version=entry.version
     )
-    index_by_location(entry_location)
-
-
-def generate_nearai_metadata_json(agent_py, metadata_json, entry_location_str, output_directory: str = "./cards"):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    logging.info(f"Requesting LLM to generate NEAR AI metadata.json Card.")
-    resp = client.responses.create(
-        instructions="You're very good python engineer, and you can understand the python code very well."
-                     "You're provided with the python code that is a entrypoint to the agent (agent.py).  "
-                     "You're provided with the current description of the agent that can be incomplete (metadata.json)."
-                     "Your task is to generate very detailed description on what this agent is doing, but do not go into technical"
-                     "details, description should be in business language and not in technical language. "
-                     "And return it in the format of agent card with given schema:"
-                     f"{json.dumps(NearAIMetadataCard.model_json_schema(), indent=2)}",
+    await index_by_location(entry_location)
+
+
+async def generate_cards(agent_py, metadata_json, entry_location_str, output_directory: str = "./cards"):
+    client = get_openai_client()
+    logging.info(f"Requesting LLM to generate Agent Card and NEAR AI metadata.json Card.")
+    # Both cards are requested at once, so the agent code is sent to the model only one time
+    resp = await client.responses.create(
+        instructions=_CARDS_INSTRUCTIONS.format(entry_location_str=entry_location_str),
         input=[
             {"role": "user", "content": f"// agent.py\n```python\n{agent_py}\n```"},
             {"role": "user", "content": f"// metadata.json\n```json\n{metadata_json}\n```"},
@@ -112,104 +158,124 @@ def generate_nearai_metadata_json(agent_py, metadata_json, entry_location_str, o
     )
 
     card_raw = resp.output[1].content[0].text
-    logging.info(f"Agent card for {entry_location_str} created.")
+    logging.info(f"Agent cards for {entry_location_str} created.")
+
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    card_file_path = Path(output_directory, f"{entry_location_str.replace('/', '_')}.json")
+    metadata_file_path = Path(output_directory, f"{entry_location_str.replace('/', '_')}_metadata.json")
 
-    Path('./cards').mkdir(exist_ok=True)
-    card_file_path = Path(output_directory, f"{entry_location_str.replace('/', '_')}_metadata.json")
+    # Bare JSON answers are used as is, backticks inside their strings are not fences
+    card_raw = card_raw.strip()
+    if not card_raw.startswith("{"):
+        match = _FENCE_RE.search(card_raw)
+        if match:
+            card_raw = match.group(1)
 
     try:
-        if "```json" in card_raw:
-            card_raw = card_raw.split("```json")[1].split("```")[0]
+        # pydantic-core parses and validates the whole answer straight from JSON
+        cards = _CARDS_ADAPTER.validate_json(card_raw)
+        a2a_card, near_card = cards.a2a, cards.near
+    except ValidationError:
+        # Cards succeed or fail independently, a broken one doesn't discard the other
+        a2a_card, near_card = validate_cards_separately(card_raw, card_file_path)
+
+    if a2a_card is not None:
+        with open(card_file_path, "w", encoding="utf-8") as f:
+            f.write(a2a_card.model_dump_json(indent=2))
+        logging.info(f"Agent card for {entry_location_str} was successfully saved to {card_file_path}.")
 
-        card = NearAIMetadataCard(**json.loads(card_raw))
-        metadata_card = json.loads(metadata_json)
-        metadata_card["description"] = card.agent_description
-        metadata_card["tags"] = card.tags
+    if near_card is not None:
+        try:
+            save_nearai_metadata_json(near_card, metadata_json, metadata_file_path)
+            logging.info(f"NEARAI metadata.json card for {entry_location_str} was successfully saved to {metadata_file_path}.")
+        except (orjson.JSONDecodeError, OSError):
+            logging.error(f"Error saving NEARAI metadata.json card {near_card}.\nError: {format_exc()}")
 
-        if metadata_card.get("details") is None:
-            metadata_card["details"] = {}
 
-        if metadata_card.get("details").get("agent") is None:
-            metadata_card["details"]["agent"] = {}
+def validate_cards_separately(card_raw, card_file_path: Path) -> Tuple[Optional[AgentCard], Optional[NearAIMetadataCard]]:
+    try:
+        cards = orjson.loads(card_raw)
+        if not isinstance(cards, dict):
+            raise ValueError("answer is not a JSON object")
+    except ValueError as e:
+        # orjson.JSONDecodeError is a ValueError as well
+        logging.error(f"Error parsing agent cards {card_raw}.\nError: {e}")
+        with open(card_file_path, "w", encoding="utf-8") as f:
+            f.write(card_raw)
+        return None, None
 
-        if metadata_card.get("details").get("agent").get("welcome") is None:
-            metadata_card["details"]["agent"]["welcome"] = {}
+    a2a_raw = cards.get("a2a")
+    try:
+        a2a_card = _A2A_ADAPTER.validate_python(a2a_raw)
+    except ValidationError:
+        a2a_card = None
+        logging.error(f"Error parsing agent card {a2a_raw}.\nError: {format_exc()}")
+        # Without an a2a object there is nothing to extract, keep the whole answer instead
+        with open(card_file_path, "wb") as f:
+            if isinstance(a2a_raw, dict):
+                f.write(orjson.dumps(a2a_raw, option=orjson.OPT_INDENT_2))
+            else:
+                f.write(card_raw.encode("utf-8"))
+
+    near_raw = cards.get("near")
+    try:
+        near_card = _NEARAI_ADAPTER.validate_python(near_raw)
+    except ValidationError:
+        near_card = None
+        logging.error(f"Error parsing NEARAI metadata.json card {near_raw}.\nError: {format_exc()}")
 
-        metadata_card["details"]["agent"]["welcome"]["description"] = card.agent_description
+    return a2a_card, near_card
 
-        with open(card_file_path, "w", encoding="utf-8") as f:
-            json.dump(metadata_card, f, indent=2)
-
-        logging.info(f"NEARAI metadata.json card for {entry_location_str} was successfully saved to {card_file_path}.")
-    except Exception as e:
-        logging.error(f"Error parsing NEARAI metadata.json card {card_raw}.\nError: {format_exc()}")
-
-def generate_a2a_card(agent_py, metadata_json, entry_location_str, output_directory: str = "./cards"):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    logging.info(f"Requesting LLM to generate Agent Card.")
-    resp = client.responses.create(
-        instructions="You're very good python engineer, and you can understand the python code very well."
-                     "You're provided with the python code that is a entrypoint to the agent (agent.py).  "
-                     "You're provided with the current description of the agent that can be incomplete (metadata.json)."
-                     "Your task is to generate very detailed description on what this agent is doing "
-                     "and return it in the format of agent card with given schema:"
-                     f"{json.dumps(AgentCard.model_json_schema(), indent=2)}"
-                     f"For the provided use: near.ai"
-                     f"For the provider url use: near.ai"
-                     f"For the agent url use: https://app.near.ai/agents/{entry_location_str}",
-        input=[
-            {"role": "user", "content": f"// agent.py\n```python\n{agent_py}\n```"},
-            {"role": "user", "content": f"// metadata.json\n```json\n{metadata_json}\n```"},
-        ],
-        model="o4-mini",
-    )
 
-    card_raw = resp.output[1].content[0].text
-    logging.info(f"Agent card for {entry_location_str} created.")
+def save_nearai_metadata_json(card: NearAIMetadataCard, metadata_json, card_file_path: Path):
+    metadata_card = orjson.loads(metadata_json)
+    metadata_card["description"] = card.agent_description
+    metadata_card["tags"] = card.tags
 
-    Path('./cards').mkdir(exist_ok=True)
-    card_file_path = Path(output_directory, f"{entry_location_str.replace('/', '_')}.json")
+    if metadata_card.get("details") is None:
+        metadata_card["details"] = {}
 
-    try:
-        if "```json" in card_raw:
-            card_raw = card_raw.split("```json")[1].split("```")[0]
+    if metadata_card.get("details").get("agent") is None:
+        metadata_card["details"]["agent"] = {}
 
-        card = AgentCard(**json.loads(card_raw))
-        with open(card_file_path, "w", encoding="utf-8") as f:
-            f.write(card.model_dump_json(indent=2))
-        logging.info(f"Agent card for {entry_location_str} was successfully saved to {card_file_path}.")
-    except Exception as e:
-        logging.error(f"Error parsing agent card {card_raw}.\nError: {format_exc()}")
-        try:
-            card = json.loads(card_raw)
-            card_raw = json.dumps(card, indent=2)
-        except Exception as e:
-            pass
+    if metadata_card.get("details").get("agent").get("welcome") is None:
+        metadata_card["details"]["agent"]["welcome"] = {}
 
-        with open(card_file_path, "w", encoding="utf-8") as f:
-            f.write(card_raw)
+    metadata_card["details"]["agent"]["welcome"]["description"] = card.agent_description
+
+    with open(card_file_path, "wb") as f:
+        f.write(orjson.dumps(metadata_card, option=orjson.OPT_INDENT_2))
 
 
-def get_agents():
+def list_agents_page(offset: int) -> List[EntryInformation]:
+    return registry.list(
+        namespace="",
+        category="agent",
+        tags="",
+        total=REGISTRY_PAGE_SIZE,
+        offset=offset,
+        show_all=True,
+        show_latest_version=True
+    )
+
+
+async def get_agents():
     logging.info("Downloading entries from NEAR AI registry")
     has_more = True
     entries: List[EntryInformation] = []
     offset = 0
     while has_more:
-        agents = registry.list(
-            namespace="",
-            category="agent",
-            tags="",
-            total=1000,
-            offset=offset,
-            show_all=True,
-            show_latest_version=True
-        )
-        entries.extend(agents)
-        if len(agents) < 1000:
-            has_more = False
-        else:
-            offset += len(agents)
+        # Total number of entries is unknown, so pages are requested in concurrent batches
+        offsets = range(offset, offset + REGISTRY_PAGE_SIZE * REGISTRY_CONCURRENT_PAGES, REGISTRY_PAGE_SIZE)
+        pages = await asyncio.gather(*(asyncio.to_thread(list_agents_page, page_offset) for page_offset in offsets))
+        for agents in pages:
+            entries.extend(agents)
+            if len(agents) < REGISTRY_PAGE_SIZE:
+                # The listing ends here, pages requested past it are dropped
+                has_more = False
+                break
+
+        offset += REGISTRY_PAGE_SIZE * REGISTRY_CONCURRENT_PAGES
 
     entries = sorted(entries, key=lambda entry: entry.num_stars, reverse=True)
 
@@ -217,16 +283,24 @@ def get_agents():
     return entries
 
 
-def index_all():
-    entries = get_agents()
-    for entry in entries:
-        index_by_entry(entry)
+async def index_all():
+    entries = await get_agents()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ENTRIES)
+
+    async def index_with_limit(entry: EntryInformation):
+        async with semaphore:
+            try:
+                await index_by_entry(entry)
+            except Exception:
+                logging.error(f"Error indexing entry {entry.namespace}/{entry.name}/{entry.version}.\nError: {format_exc()}")
+
+    await asyncio.gather(*(index_with_limit(entry) for entry in entries))
 
 
 if __name__ == "__main__":
-    # index_all()
-    index_by_location(EntryLocation(
+    # asyncio.run(index_all())
+    asyncio.run(index_by_location(EntryLocation(
         namespace="kirikiri.near",
         name="travel-assistant",
         version="0.0.121"
-    ))
\ No newline at end of file
+    )))
\ No newline at end of file